@@ -3,66 +3,112 @@
 
 import argparse
 import datetime
-from traceback import print_tb
 import dateutil.parser
+import functools
 import itertools
 import jinja2
 import logging
+from markupsafe import escape
+import operator
 import os
 import re
-import random
+import zlib
 
 # Format of the standard WhatsApp export line. This is likely to change in the
 # future and so this application will need to be updated.
-DATE_RE = '(?P<date>[\d/-]+)'
-TIME_RE = '(?P<time>[\d:]+( [AP]M)?)'
-DATETIME_RE = '\[?' + DATE_RE + ',? ' + TIME_RE + '\]?'
-SEPARATOR_RE = '( - |: | )'
-NAME_RE = '(?P<name>[^:]+)'
-WHATSAPP_RE = (DATETIME_RE +
+DATE_RE = r'(?P<date>\d[\d/-]*)'
+TIME_RE = r'(?P<time>[\d:]+( [AP]M)?)'
+DATETIME_RE = r'\[?' + DATE_RE + ',? ' + TIME_RE + r'\]?'
+SEPARATOR_RE = '(?: - |: | )'
+NAME_RE = r'(?P<name>[^:\r\n]+)'
+# A message line, or, when the name is missing, one of the lines written by
+# WhatsApp itself. A single match tells the two apart.
+COMBINED_RE = ('(?P<datetime>' + DATETIME_RE + ')' +
                SEPARATOR_RE +
-               NAME_RE +
-               ': '
+               '(?:' + NAME_RE + ': )?'
                '(?P<body>.*$)')
+_COMBINED_RE = re.compile(COMBINED_RE)
+_DATETIME_RE = re.compile(DATETIME_RE)
 
-FIRSTLINE_RE = (DATETIME_RE +
-               SEPARATOR_RE +
-               '(?P<body>.*$)')
+# Date layouts seen in WhatsApp exports, tried with strptime before falling
+# back to dateutil. All of them are day-first, like the dateutil call.
+DATETIME_FORMATS = tuple(
+    date + ' ' + time
+    for date in ('%d/%m/%Y', '%d/%m/%y', '%d-%m-%Y', '%d-%m-%y')
+    for time in ('%H:%M', '%H:%M:%S', '%I:%M %p', '%I:%M:%S %p'))
+# Index of the format that matched last; lines of one export share a format.
+_last_format = 0
+
+# Attached files are marked with this suffix; their extension tells the kind.
+ATTACHMENT_SUFFIX = ' (arquivo anexado)'
+ATTACHMENT_KINDS = {
+    'opus': 'audio',
+    'mp3': 'audio',
+    'mp4': 'video',
+    'jpg': 'image',
+}
 
 
 class Error(Exception):
     """Something bad happened."""
 
 
+# Many messages share a timestamp, so the same strings come up again and again.
+@functools.lru_cache(maxsize=1024)
+def ParseDateTime(date, time):
+    """Parses the date and time fields of a line."""
+    global _last_format
+    s = "%s %s" % (date, time)
+    try:
+        return datetime.datetime.strptime(s, DATETIME_FORMATS[_last_format])
+    except ValueError:
+        pass
+    for i, fmt in enumerate(DATETIME_FORMATS):
+        if i == _last_format:
+            continue
+        try:
+            d = datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        _last_format = i
+        return d
+    return dateutil.parser.parse(s, dayfirst=True)
+
+
 def ParseLine(line):
     """Parses a single line of WhatsApp export file."""
-    m = re.match(WHATSAPP_RE, line)
-    if m:
-        d = dateutil.parser.parse("%s %s" % (m.group('date'),
-            m.group('time')), dayfirst=True)
-        return d, m.group('name'), m.group('body')
-    # Maybe it's the first line which doesn't contain a person's name.
-    m = re.match(FIRSTLINE_RE, line)
-    if m:
-        a = re.match(DATETIME_RE, line)
-        if (a.end()-a.start()) != 16:
+    # Messages start with a date, possibly in brackets. Continuation lines
+    # are turned down here without running the regex.
+    first = line[:1]
+    if first != '[' and not first.isdigit():
+        return None
+    m = _COMBINED_RE.match(line)
+    if m is None:
+        return None
+    name = m.group('name')
+    if name is None:
+        # Maybe it's the first line which doesn't contain a person's name.
+        # The datetime is measured on its own: inside COMBINED_RE it may give
+        # up an AM/PM suffix so that the separator matches.
+        if _DATETIME_RE.match(line).end() != 16:
             return None
-            
-    if m:
-        d = dateutil.parser.parse("%s %s" % (m.group('date'),
-            m.group('time')), dayfirst=True)
-        return d, "Whatsapp", m.group('body')
-    return None
-    
+        name = "Whatsapp"
+    d = ParseDateTime(m.group('date'), m.group('time'))
+    return d, name, m.group('body')
+
 
 def IdentifyMessages(lines):
     """Input text can contain multi-line messages. If there's a line that
     doesn't start with a date and a name, that's probably a continuation of the
     previous message and should be appended to it.
+
+    lines can be any iterable of lines, such as an open file; it is read
+    once, front to back.
     """
     messages = []
     msg_date = None
     msg_user = None
+    # Lines of the current message body, joined once the message is complete.
     msg_body = None
     for line in lines:
         m = ParseLine(line)
@@ -71,20 +117,102 @@ def IdentifyMessages(lines):
                 # We have a new message, so there will be no more lines for the
                 # one we've seen previously -- it's complete. Let's add it to
                 # the list.
-                messages.append((msg_date, msg_user, msg_body))
-            msg_date, msg_user, msg_body = m
+                messages.append((msg_date, msg_user, '\n'.join(msg_body)))
+            msg_date, msg_user, body = m
+            msg_body = [body]
         else:
             if msg_date is None:
                 raise Error("Can't parse the first line: " + repr(line) +
-                        ', regexes are FIRSTLINE_RE=' + repr(FIRSTLINE_RE) +
-                        ' and WHATSAPP_RE=' + repr(WHATSAPP_RE))
-            msg_body += '\n' + line.strip()
+                        ', regex is COMBINED_RE=' + repr(COMBINED_RE))
+            msg_body.append(line.strip())
     # The last message remains. Let's add it, if it exists.
     if msg_date is not None:
-        messages.append((msg_date, msg_user, msg_body))
+        messages.append((msg_date, msg_user, '\n'.join(msg_body)))
     return messages
 
 
+def CSSClass(user):
+    """Turns a user name into something usable as a CSS class."""
+    return user.replace('+', 'b').replace(' ', '-').replace('.', '')
+
+
+class Message:
+    """A message as the template sees it. Built by MessageData."""
+    __slots__ = ('date', 'date_str', 'user', 'user_html', 'body', 'body_html',
+                 'user_class', 'div_class', 'is_missed_call', 'kind',
+                 'attachment_name', 'attachment_label', 'location_url',
+                 'body_html_lines')
+
+    def __init__(self, date, user, body, user_html, user_class, div_class):
+        self.date = date
+        self.date_str = date.strftime('%Y-%m-%d %H:%M:%S')
+        self.user = user
+        self.user_html = user_html
+        self.body = body
+        self.body_html = escape(body)
+        self.user_class = user_class
+        self.div_class = div_class
+        self.is_missed_call = (body == "Chamada de voz perdida" or
+                               body == "Chamada de vídeo perdida")
+        self.kind = 'text'
+        self.attachment_name = None
+        self.attachment_label = None
+        self.location_url = None
+        self.body_html_lines = None
+
+
+def UserColor(user):
+    """Picks a CSS color for a user from a hash of the name, so a user keeps
+    the same color across runs."""
+    h = zlib.crc32(user.encode('utf-8'))
+    return 'rgb(%d, %d, %d)' % tuple(100 + (h >> shift & 0xFF) % 101
+                                     for shift in (0, 8, 16))
+
+
+def MessageData(message, user_html, user_class, div_class):
+    """Precomputes everything the template needs to render a message. Text
+    that ends up in the page is HTML-escaped here, not in the template.
+    Returns:
+        A Message.
+    """
+    date, user, body = message
+    m = Message(date, user, body, user_html, user_class, div_class)
+    loc = body.find('localização:')
+    if loc >= 0:
+        m.kind = 'location'
+        m.location_url = escape(body[loc+13:])
+    elif body.endswith(ATTACHMENT_SUFFIX):
+        _, dot, ext = body[:-len(ATTACHMENT_SUFFIX)].rpartition('.')
+        kind = ATTACHMENT_KINDS.get(ext) if dot else None
+        if kind in ('audio', 'video'):
+            m.kind = kind
+        elif '.webp (arquivo' in body:
+            m.kind = 'sticker'
+        else:
+            m.kind = kind or 'file'
+    elif body.endswith('.mp3'):
+        m.kind = 'audio'
+    elif '.webp (arquivo' in body:
+        m.kind = 'sticker'
+    elif '(arquivo anexado)' in body:
+        m.kind = 'file'
+    elif '\n' in body:
+        m.kind = 'lines'
+        m.body_html_lines = [escape(x) for x in body.split('\n')]
+    if m.kind in ('audio', 'video', 'sticker', 'image', 'file'):
+        # File names start with an invisible direction mark, skip it.
+        i = body.find(' (arquivo')
+        m.attachment_name = escape(body[1:i] if i >= 0 else body)
+    if m.kind == 'file':
+        paren = body.find(')')
+        if paren + 1 < len(body):
+            m.attachment_label = escape(body[paren+2:])
+        else:
+            m.attachment_label = escape(
+                body.replace(" (arquivo anexado)", ""))
+    return m
+
+
 def TemplateData(messages, input_filename):
     """Create a struct suitable for procesing in a template.
     Returns:
@@ -92,29 +220,84 @@ def TemplateData(messages, input_filename):
     """
     by_user = []
     file_basename = os.path.basename(input_filename)
-    for user, msgs_of_user in itertools.groupby(messages, lambda x: x[1]):
-        by_user.append((user, list(msgs_of_user)))
+    user_html = {}
+    css_class = {}
+    div_class = {}
+    colors = {}
+    for user, msgs_of_user in itertools.groupby(messages, operator.itemgetter(1)):
+        if user not in css_class:
+            user_html[user] = escape(user)
+            css_class[user] = CSSClass(user)
+            div_class[user] = user.replace(' ', '_')
+            colors[user] = UserColor(user)
+        by_user.append((user, [MessageData(m, user_html[user], css_class[user],
+                                           div_class[user])
+                               for m in msgs_of_user]))
     
-    l = []
-    n = []
-    for i in by_user:
-        if i[0] not in n:
-            l.append((i[0], (random.randint(100, 200), random.randint(100, 200), random.randint(100, 200))))
-            n.append(i[0])
-    
-    """
-        by_user =
-            [grupo de mensagens por usuário que enviou, vai de 0 até a quantidade de agrupamentos de mensagens por pessoa]
-            [0 - usuário que enviou aquele grupo de mensagens; 1 - grupo de mensagens]
-            [tuplas com: (data, usuário, mensagem), todas as mensagens daquele grupo de mensagens]
-            [3 valores: 0 - horário da mensagem; 1 - usuário da mensagem; 2 - mensagem]
-    """
+    # by_user =
+    #     [grupo de mensagens por usuário que enviou, vai de 0 até a quantidade de agrupamentos de mensagens por pessoa]
+    #     [0 - usuário que enviou aquele grupo de mensagens; 1 - grupo de mensagens]
+    #     [objetos Message, todas as mensagens daquele grupo de mensagens]
     return dict(by_user=by_user, input_basename=file_basename,
-            input_full_path=input_filename, users=l)
+            input_full_path=input_filename, users=list(colors.items()),
+            css_class=css_class)
 
 
-def FormatHTML(data):
-    tmpl = """<!DOCTYPE html>
+_TMPL_STRING = """{% macro render_message(m, side_class) %}
+                <li class="{{ side_class }}">
+                {% if side_class == "Whatsapp" %}
+                    <div class="Whatsapp-c">
+                        <span class="date">{{ m.date_str }} -</span>
+                        <span class="{{ m.user_class }}" >{{ m.user_html }}: </span>
+                        {{ m.body_html }}
+                    </div>
+                {% else %}
+                    <div class="{{ m.div_class }}">
+                        <span class="date">{{ m.date_str }} -</span>
+                        <span class="{{ m.user_class }}" >{{ m.user_html }}: </span>
+                        {% if m.is_missed_call %}
+                            <img id="missed-call" src='https://cdn-icons.flaticon.com/png/512/5604/premium/5604556.png?token=exp=1649681187~hmac=85540c3c1ac7984f32c86a041484e55f'>
+                        {% endif %}
+                        {% if m.kind == 'location' %}
+                            localização: <a href={{ m.location_url }} target='_blank'>{{ m.location_url }}</a>
+                        {% elif m.kind == 'audio' %}
+                            <audio controls>
+                                <source src="./Midias/{{ m.attachment_name }}" type="audio/mp3">
+                                <source src="./Midias/{{ m.attachment_name }}" type="audio/ogg">
+                                Seu navegador não possui suporte para áudio.
+                            </audio>
+                        {% elif m.kind == 'video' %}
+                            <video controls>
+                                <source src="./Midias/{{ m.attachment_name }}" type="video/mp4">
+                                <source src="./Midias/{{ m.attachment_name }}" type="video/ogg">
+                                Seu navegador não possui suporte para Vídeos.
+                            </video>
+                        {% elif m.kind == 'sticker' %}
+                            <picture>
+                                <source srcset="./Midias/{{ m.attachment_name }}" type="image/webp">
+                                <source srcset="./Midias/{{ m.attachment_name }}" type="image/jpeg">
+                                <img src="./Midias/{{ m.attachment_name }}">
+                            </picture>
+                        {% elif m.kind == 'image' %}
+                            <input type="checkbox" id="zoomCheck-{{ m.attachment_name }}">
+                            <label for='zoomCheck-{{ m.attachment_name }}'>
+                                <img src='./Midias/{{ m.attachment_name }}'>
+                            </label>
+                        {% elif m.kind == 'file' %}
+                            <a href='./Midias/{{ m.attachment_name }}' target="_blank" download>{{ m.attachment_label }}</a>
+                        {% elif m.kind == 'lines' %}
+                            {% for i in m.body_html_lines %}
+                            {{ i }}
+                            <br>
+                            {% endfor %}
+                        {% else %}
+                            {{ m.body_html }}
+                        {% endif %}
+                    </div>
+                {% endif %}
+                </li>
+    {% endmacro -%}
+    <!DOCTYPE html>
     <html>
     <head>
         <title>WhatsApp {{ input_basename }}</title>
@@ -227,10 +410,10 @@ def FormatHTML(data):
                 color: #ccbfb9;
             }
         {% for u in users %}
-            span.{{ u[0].replace(' ', '-').replace("+", 'b').replace('.','') }} {
+            span.{{ css_class[u[0]] }} {
                 margin: 0 2px;
                 font-weight: bold;
-                color: rgb{{ u[1] }};
+                color: {{ u[1] }};
             }
         {% endfor %}
             span.date {
@@ -242,180 +425,17 @@ def FormatHTML(data):
         <h1>{{ input_basename }}</h1>
         <ol class="users">
         {% for user, messages in by_user %}
-            <li class="conjunto">
-            <ol class="messages">
-        {% for message in messages %}
             {% if user == "Whatsapp" %}
-                <li class="Whatsapp">
-                    <div class="Whatsapp-c">
-                        <span class="date">{{ message[0] }} -</span>
-                        <span class="{{ user.replace(' ', '-') }}" >{{ user }}: </span>
-                        {{message[2] | e}}
-                    </div>
-                </li>
-            {% elif users|length <= 3 %}
-                {% if user in input_basename %}
-                <li class="le">
-                    <div class="{{ user.replace(' ', '_') }}">
-                        <span class="date">{{ message[0] }} -</span>
-                        <span class="{{ user.replace("+", 'b').replace(' ', '-').replace('.','') }}" >{{ user }}: </span>
-                        {% if message[2] == "Chamada de voz perdida" or message[2] == "Chamada de vídeo perdida" %}
-                            <img id="missed-call" src='https://cdn-icons.flaticon.com/png/512/5604/premium/5604556.png?token=exp=1649681187~hmac=85540c3c1ac7984f32c86a041484e55f'>
-                        {% endif %}
-                        {% if "localização:" in message[2] %}
-                            localização: <a href={{message[2][message[2].index('localização:')+13:] | e }} target='_blank'>{{message[2][message[2].index('localização:')+13:] | e }}</a>
-                        
-                        {% elif message[2].endswith('.opus (arquivo anexado)') or message[2].endswith('.mp3 (arquivo anexado)') or message[2].endswith('.mp3') %}
-                            <audio controls>
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="audio/mp3">
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="audio/ogg">
-                                Seu navegador não possui suporte para áudio.
-                            </audio>
-
-                        {% elif message[2].endswith('.mp4 (arquivo anexado)') %}
-                            <video controls>
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="video/mp4">
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="video/ogg">
-                                Seu navegador não possui suporte para Vídeos.
-                            </video>
-                        
-                        {% elif ('.webp (arquivo') in message[2] %}
-                            <picture>
-                                <source srcset="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="image/webp">
-                                <source srcset="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="image/jpeg">
-                                <img src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}">
-                            </picture>
-
-                        {% elif message[2].endswith('.jpg (arquivo anexado)') %}
-                            <input type="checkbox" id="zoomCheck-{{ message[2][1:message[2].index(' (arquivo')] | e }}">
-                            <label for='zoomCheck-{{ message[2][1:message[2].index(' (arquivo')] | e }}'>
-                                <img src='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}'>                    
-                            </label>
-                        
-                        {% elif '(arquivo anexado)' in message[2] %}
-                            {% if message[2][message[2].index(')')+1:] %}
-                                <a href='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}' target="_blank" download>{{ message[2][message[2].index(')')+2:] | e }}</a>
-                            {% else %}
-                                <a href='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}' target="_blank" download>{{ message[2].replace(" (arquivo anexado)","") | e }}</a>
-                            {% endif %}
-                        {% else %}
-                            {% if '\n' in message[2] %}
-                                {% for i in message[2].split("\n") %}
-                                {{ i }}
-                                <br>
-                                {% endfor %}
-                            {% else %}
-                                {{ message[2] | e }}
-                            {% endif %}
-                        {% endif %}
-                    </div>
-                </li>
-                {% else %}
-                <li class="ri">
-                    <div class="{{ user.replace(' ', '_') }}">
-                        <span class="date">{{ message[0] }} -</span>
-                        <span class="{{ user.replace("+", 'b').replace(' ', '-').replace('.','') }}" >{{ user }}: </span>
-                        {% if message[2] == "Chamada de voz perdida" or message[2] == "Chamada de vídeo perdida" %}
-                            <img id="missed-call" src='https://cdn-icons.flaticon.com/png/512/5604/premium/5604556.png?token=exp=1649681187~hmac=85540c3c1ac7984f32c86a041484e55f'>
-                        {% endif %}
-                        {% if "localização:" in message[2] %}
-                            localização: <a href={{message[2][message[2].index('localização:')+13:] | e }} target='_blank'>{{message[2][message[2].index('localização:')+13:] | e }}</a>
-                        
-                        {% elif message[2].endswith('.opus (arquivo anexado)') or message[2].endswith('.mp3 (arquivo anexado)') or message[2].endswith('.mp3') %}
-                            <audio controls>
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="audio/mp3">
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="audio/ogg">
-                                Seu navegador não possui suporte para áudio.
-                            </audio>
-
-                        {% elif message[2].endswith('.mp4 (arquivo anexado)') %}
-                            <video controls>
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="video/mp4">
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="video/ogg">
-                                Seu navegador não possui suporte para Vídeos.
-                            </video>
-
-                        {% elif ('.webp (arquivo') in message[2] %}
-                            <picture>
-                                <source srcset="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="image/webp">
-                                <source srcset="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="image/jpeg">
-                                <img src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}">
-                            </picture>
-
-                        {% elif message[2].endswith('.jpg (arquivo anexado)') %}
-                            <input type="checkbox" id="zoomCheck-{{ message[2][1:message[2].index(' (arquivo')] | e }}">
-                            <label for='zoomCheck-{{ message[2][1:message[2].index(' (arquivo')] | e }}'>
-                                <img src='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}'>                    
-                            </label>
-
-                        {% elif '(arquivo anexado)' in message[2] %}
-                            {% if message[2][message[2].index(')')+1:] %}
-                                <a href='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}' target="_blank" download>{{ message[2][message[2].index(')')+2:] | e }}</a>
-                            {% else %}
-                                <a href='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}' target="_blank" download>{{ message[2].replace(" (arquivo anexado)","") | e }}</a>
-                            {% endif %}
-                        {% else %} 
-                            {% if '\n' in message[2] %}
-                                {% for i in message[2].split("\n") %}
-                                {{ i }}
-                                <br>
-                                {% endfor %}
-                            {% else %}
-                                {{ message[2] | e }}
-                            {% endif %}
-                        {% endif %}
-                    </div>
-                </li>
-
-                {% endif %}
+                {% set side_class = "Whatsapp" %}
+            {% elif users|length <= 3 and user not in input_basename %}
+                {% set side_class = "ri" %}
             {% else %}
-                <li class="le">
-                    <div class="{{ user.replace(' ', '_') }}">
-                        <span class="date">{{ message[0] }} -</span>
-                        <span class="{{ user.replace(' ', '-').replace("+", "b").replace('.','') }}" >{{ user }}: </span>
-                        {% if message[2] == "Chamada de voz perdida" or message[2] == "Chamada de vídeo perdida" %}
-                            <img id="missed-call" src='https://cdn-icons.flaticon.com/png/512/5604/premium/5604556.png?token=exp=1649681187~hmac=85540c3c1ac7984f32c86a041484e55f'>
-                        {% endif %}
-                        {% if "localização:" in message[2] %}
-                            localização: <a href={{message[2][message[2].index('localização:')+13:] | e }} target='_blank'>{{message[2][message[2].index('localização:')+13:] | e }}</a>
-                        {% elif message[2].endswith('.opus (arquivo anexado)') or message[2].endswith('.mp3 (arquivo anexado)') or message[2].endswith('.mp3') %}
-                            <audio controls>
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="audio/ogg">
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="audio/mp3">
-                                Seu navegador não possui suporte para áudio.
-                            </audio>
-
-                        {% elif message[2].endswith('.mp4 (arquivo anexado)') %}
-                            <video controls>
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="video/mp4">
-                                <source src="./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}" type="video/ogg">
-                                Seu navegador não possui suporte para Vídeos.
-                            </video>
-
-                        {% elif message[2].endswith('.jpg (arquivo anexado)') %}
-                            <input type="checkbox" id="zoomCheck-{{ message[2][1:message[2].index(' (arquivo')] | e }}">
-                            <label for='zoomCheck-{{ message[2][1:message[2].index(' (arquivo')] | e }}'>
-                                <img src='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}'>                    
-                            </label>
-                        {% elif '(arquivo anexado)' in message[2] %}
-                            {% if message[2][message[2].index(')')+1:] %}
-                                <a href='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}' target="_blank" download>{{ message[2][message[2].index(')')+2:] | e }}</a>
-                            {% else %}
-                                <a href='./Midias/{{ message[2][1:message[2].index(' (arquivo')] | e }}' target="_blank" download>{{ message[2].replace(" (arquivo anexado)","") | e }}</a>
-                            {% endif %}
-                        {% else %}
-                            {% if '\n' in message[2] %}
-                                {% for i in message[2].split("\n") %}
-                                {{ i }}
-                                <br>
-                                {% endfor %}
-                            {% else %}
-                                {{ message[2] | e }}
-                            {% endif %}
-                        {% endif %}
-                    </div>
-                </li>
+                {% set side_class = "le" %}
             {% endif %}
+            <li class="conjunto">
+            <ol class="messages">
+        {% for m in messages %}
+            {{ render_message(m, side_class) }}
         {% endfor %}
             </ol>
             <br>
@@ -425,7 +445,46 @@ def FormatHTML(data):
     </body>
     </html>
     """
-    return jinja2.Environment().from_string(tmpl).render(**data)
+
+# The compiled template is kept on disk between runs. Jinja only caches
+# bytecode for templates that come from a loader, hence the DictLoader.
+# Cache entries are only checked against the template source, so bump
+# _CACHE_VERSION whenever the Environment options below change. The cache
+# lives under the user's home, which unlike the temp dir survives reboots.
+_CACHE_VERSION = 2
+_CACHE_DIR = os.path.expanduser(os.path.join('~', '.cache', 'whatsapp-archive'))
+
+
+def _JinjaEnvironment(bytecode_cache):
+    return jinja2.Environment(
+        autoescape=False,
+        trim_blocks=True,
+        lstrip_blocks=True,
+        loader=jinja2.DictLoader({'chat.html': _TMPL_STRING}),
+        bytecode_cache=bytecode_cache)
+
+
+@functools.lru_cache(maxsize=None)
+def _Template():
+    """Loads the page template, on first use rather than at import time. The
+    bytecode cache is only a speed-up: if its directory can't be created or
+    written to, the template is compiled without it."""
+    try:
+        os.makedirs(_CACHE_DIR, mode=0o700, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(
+            _CACHE_DIR, '__jinja2_v%d_%%s.cache' % _CACHE_VERSION)
+        return _JinjaEnvironment(bytecode_cache).get_template('chat.html')
+    except OSError as e:
+        logging.warning('Template bytecode cache disabled: %s', e)
+        return _JinjaEnvironment(None).get_template('chat.html')
+
+
+def FormatHTML(data, fd):
+    """Writes the page to fd, a file opened in binary mode, as it's rendered
+    instead of building it in memory first."""
+    stream = _Template().stream(**data)
+    stream.enable_buffering(100)
+    stream.dump(fd, encoding='utf-8')
 
 def main():
     logging.basicConfig(level=logging.INFO)
@@ -436,16 +495,15 @@ def main():
     args = parser.parse_args()
 
     with open(args.input_file, 'rt', encoding='utf-8-sig') as fd:
-        messages = IdentifyMessages(fd.readlines())
+        messages = IdentifyMessages(fd)
 
     template_data = TemplateData(messages, args.input_file)
-    HTML = FormatHTML(template_data)
 
-    with open(args.output_file, 'w', encoding='utf-8') as fd:
-        fd.write(HTML)
+    with open(args.output_file, 'wb') as fd:
+        FormatHTML(template_data, fd)
     
-    print("Entrada=",parser.parse_args().input_file)
-    print("Saída=",parser.parse_args().output_file)
+    print("Entrada=",args.input_file)
+    print("Saída=",args.output_file)
 
 
 if __name__ == '__main__':